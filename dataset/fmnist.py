@@ -1,9 +1,23 @@
 import os
-import idx2numpy
+import torch
 from torch.utils.data import Dataset
 import numpy as np
 import cv2
 
+# numpy dtypes of the IDX type codes (multi-byte values are big-endian)
+_IDX_DTYPES = {0x08: np.uint8, 0x09: np.int8, 0x0B: '>i2', 0x0C: '>i4', 0x0D: '>f4', 0x0E: '>f8'}
+
+def _read_idx_mmap(path):
+    """
+    memory-map an IDX file, so that only the sliced part of the data is read from disk
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+        assert magic[0] == 0 and magic[1] == 0 and magic[2] in _IDX_DTYPES, "Not an IDX file: {}".format(path)
+        ndim = magic[3]
+        shape = tuple(np.frombuffer(f.read(4 * ndim), dtype='>u4').astype(int))
+    return np.memmap(path, dtype=_IDX_DTYPES[magic[2]], mode='r', offset=4 + 4 * ndim, shape=shape)
+
 class FMNIST_silo(Dataset):
     """
     load fmnist dataset from local directory, with silo partition
@@ -18,11 +32,18 @@ class FMNIST_silo(Dataset):
         xte_file = os.path.join(dataset_dir, 't10k-images-idx3-ubyte')
         yte_file = os.path.join(dataset_dir, 't10k-labels-idx1-ubyte')
 
-        # partition the dataset into silos
-        xtr = idx2numpy.convert_from_file(xtr_file)[silo*(args.sample):(silo+1)*(args.sample)].astype(np.float32)
-        ytr = idx2numpy.convert_from_file(ytr_file)[silo*(args.sample):(silo+1)*(args.sample)].astype(np.int64)
-        xte = idx2numpy.convert_from_file(xte_file)[silo*(args.sample//4):(silo+1)*(args.sample//4)].astype(np.float32)
-        yte = idx2numpy.convert_from_file(yte_file)[silo*(args.sample//4):(silo+1)*(args.sample//4)].astype(np.int64)
+        # partition the dataset into silos (only the silo range is read), images stay uint8 until they are fetched
+        xtr = _read_idx_mmap(xtr_file)[silo*(args.sample):(silo+1)*(args.sample)]
+        ytr = _read_idx_mmap(ytr_file)[silo*(args.sample):(silo+1)*(args.sample)].astype(np.int64)
+        xte = _read_idx_mmap(xte_file)[silo*(args.sample//4):(silo+1)*(args.sample//4)]
+        yte = _read_idx_mmap(yte_file)[silo*(args.sample//4):(silo+1)*(args.sample//4)].astype(np.int64)
+
+        # rotate each silo with a different angle, the rotation matrix is shared by all its images
+        angles = [0, 0, 0, -50, 120] if self.num_silo == 5 else [0, 0, 0, -50, -50, -50, 120, 120, 120]
+        h, w = xtr.shape[1:3]
+        self._M = cv2.getRotationMatrix2D((w / 2, h / 2), angles[silo], 1.0)
+        # per-silo noise generator, seeded from the silo and folder so that it is reproducible
+        self._rng = np.random.default_rng([silo, int(folder == 'val')])
 
         if folder == 'val':
             self.data = self.transform(xte, silo)
@@ -30,37 +51,27 @@ class FMNIST_silo(Dataset):
         else:
             self.data = self.transform(xtr, silo)
             self.label = ytr
+        # convert once to tensors so that DataLoader workers and pinned memory can be used directly
+        self.data = torch.from_numpy(np.ascontiguousarray(self.data))
+        self.label = torch.from_numpy(self.label)
         print('{} folder image and label shape:'.format(folder), self.data.shape, self.label.shape)
     
     # augment data silos with different angles
-    def augment_silos(self, x, silo, num_silo):
-        angles = [0, 0, 0, -50, 120] if num_silo == 5 else [0, 0, 0, -50, -50, -50, 120, 120, 120]
-        
-        angle = angles[silo]
-        if len(x.shape) == 3:
-            h, w, c = x.shape
-            gaussian = np.random.normal(0, 100**0.5, (h,w, c))
-        else:
-            h, w = x.shape
-            gaussian = np.random.normal(0, 100**0.5, (h,w))
-        if self.noise:
-            if silo > 5:
-                x = x+gaussian.astype(np.float32)
-        center = (w / 2, h / 2)
-        M = cv2.getRotationMatrix2D(center, angle, 1.0)
+    def transform(self, x, silo):
+        n, h, w = x.shape[:3]
 
-        return cv2.warpAffine(x, M, (w, h))
+        # generate the noise for the whole silo at once (noisy silos are warped in float32)
+        if self.noise and silo > 5:
+            x = x.astype(np.float32)
+            x += self._rng.standard_normal(x.shape, dtype=np.float32) * 10.0
 
-    def transform(self, x, silo):
-        rotate_x = []
-        for i in range(x.shape[0]):
-            rotate_x.append(self.augment_silos(x[i], silo, self.num_silo))
-        rotate_x = np.asarray(rotate_x)
-        rotate_x = np.expand_dims(rotate_x, axis=1)
-        return rotate_x
+        rotate_x = np.empty(x.shape, dtype=x.dtype)
+        for i in range(n):
+            cv2.warpAffine(x[i], self._M, (w, h), dst=rotate_x[i], flags=cv2.INTER_LINEAR)
+        return rotate_x[:, None]
     
     def __len__(self):
         return self.data.shape[0]
 
     def __getitem__(self, index):
-        return self.data[index], self.label[index]
+        return self.data[index].float(), self.label[index]
@@ -5,15 +5,62 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from sklearn.cluster import KMeans
 
 from model.basemodel import Mlp, CNNEncoder, vggEncoder
 
+@torch.jit.script
+def _vq_assign(rows, codes_t, codes_sq_half):
+    """
+    argmin_k ||x - q_k||^2 == argmin_k (0.5*||q_k||^2 - x.q_k), scripted so the scoring and argmin can be fused
+    """
+    return torch.addmm(codes_sq_half, rows, codes_t, alpha=-1.0, beta=1.0).argmin(1)
+
+def _nearest_codes(flat_input, codes_t, codes_sq_half, chunk=4096, dtype=None):
+    """
+    index of the nearest codeword for each row, computed in blocks of rows so that
+    the full (N, K) distance matrix is never materialized;
+    dtype (e.g. torch.bfloat16) optionally lowers the precision of the distance matmul
+    """
+    indices = torch.empty(flat_input.shape[0], dtype=torch.long, device=flat_input.device)
+    with torch.no_grad():
+        if dtype is not None:
+            codes_t, codes_sq_half = codes_t.to(dtype), codes_sq_half.to(dtype)
+        for start in range(0, flat_input.shape[0], chunk):
+            rows = flat_input[start:start+chunk]
+            if dtype is not None:
+                rows = rows.to(dtype)
+            indices[start:start+chunk] = _vq_assign(rows, codes_t, codes_sq_half)
+    return indices
+
+def _gpu_kmeans(feas, num_clusters, n_iter=25, chunk=65536):
+    """
+    k-means++ initialization followed by Lloyd iterations, on the device of the features
+    """
+    n, d = feas.shape
+    feas_sq = feas.pow(2).sum(1)
+    centers = torch.empty(num_clusters, d, dtype=feas.dtype, device=feas.device)
+
+    # k-means++: sample each new center with probability proportional to its squared distance
+    centers[0] = feas[torch.randint(n, (1,), device=feas.device)]
+    min_dist = feas_sq - 2. * (feas @ centers[0]) + centers[0].pow(2).sum()
+    for k in range(1, num_clusters):
+        i = torch.multinomial(min_dist.clamp_min(1e-12), 1)
+        centers[k] = feas[i]
+        min_dist = torch.minimum(min_dist, feas_sq - 2. * (feas @ centers[k]) + centers[k].pow(2).sum())
+
+    # Lloyd iterations, empty clusters keep their previous center
+    for _ in range(n_iter):
+        assign = _nearest_codes(feas, centers.t(), 0.5 * centers.pow(2).sum(1), chunk)
+        sums = torch.zeros_like(centers).index_add_(0, assign, feas)
+        counts = torch.bincount(assign, minlength=num_clusters).unsqueeze(1)
+        centers = torch.where(counts > 0, sums / counts.clamp_min(1), centers)
+    return centers
+
 class VectorQuantizer(nn.Module):
     """
     Basic codebook (discrete VQ layer)
     """
-    def __init__(self, num_embeddings, embedding_dim, commitment_cost):
+    def __init__(self, num_embeddings, embedding_dim, commitment_cost, dist_dtype=None):
         super(VectorQuantizer, self).__init__()
         
         self._embedding_dim = embedding_dim
@@ -22,27 +69,23 @@ class VectorQuantizer(nn.Module):
         self.embeddings = nn.Embedding(self._num_embeddings, self._embedding_dim)
         self.embeddings.weight.data.normal_()
         self._commitment_cost = commitment_cost
+        self._dist_dtype = dist_dtype # optional lower precision for the distance matmul
 
     def forward(self, inputs):
-        # convert inputs from BCHW -> BHWC
-        inputs = inputs.permute(0, 2, 3, 1).contiguous()
+        # convert inputs from BCHW -> BHWC (a free view for channels_last inputs)
+        inputs = inputs.permute(0, 2, 3, 1)
         input_shape = inputs.shape
         
         # Flatten input
-        flat_input = inputs.view(-1, self._embedding_dim)
+        flat_input = inputs.reshape(-1, self._embedding_dim)
         
-        # Calculate distances
-        distances = (torch.sum(flat_input**2, dim=1, keepdim=True) 
-                    + torch.sum(self.embeddings.weight**2, dim=1)
-                    - 2 * torch.matmul(flat_input, self.embeddings.weight.t()))
-            
-        # Encoding
-        encoding_indices = torch.argmin(distances, dim=1).unsqueeze(1)
-        encodings = torch.zeros(encoding_indices.shape[0], self._num_embeddings, device=inputs.device)
-        encodings.scatter_(1, encoding_indices, 1)
+        # Encoding with distances to the codewords (||x||^2 is constant for each row, so it is dropped for argmin)
+        codes_sq_half = 0.5 * self.embeddings.weight.pow(2).sum(1)
+        encoding_indices = _nearest_codes(flat_input, self.embeddings.weight.t(), codes_sq_half, dtype=self._dist_dtype)
+        counts = torch.bincount(encoding_indices, minlength=self._num_embeddings).float()
         
         # Quantize and unflatten
-        quantized = torch.matmul(encodings, self.embeddings.weight).view(input_shape)
+        quantized = F.embedding(encoding_indices, self.embeddings.weight).view(input_shape)
         
         # Loss
         e_latent_loss = F.mse_loss(quantized.detach(), inputs)
@@ -50,69 +93,64 @@ class VectorQuantizer(nn.Module):
         loss = q_latent_loss + self._commitment_cost * e_latent_loss
         
         quantized = inputs + (quantized - inputs).detach()
-        avg_probs = torch.mean(encodings, dim=0)
-        perplexity = torch.exp(-torch.sum(avg_probs * torch.log(avg_probs + 1e-10)))
+        avg_probs = counts / encoding_indices.numel()
+        perplexity = torch.exp(torch.special.entr(avg_probs).sum())
         
-        # convert quantized from BHWC -> BCHW
-        return quantized.permute(0, 3, 1, 2).contiguous(), loss, perplexity
+        # convert quantized from BHWC -> BCHW (channels_last view, no copy)
+        return quantized.permute(0, 3, 1, 2), loss, perplexity
     
 class VectorQuantizerEMA(nn.Module):
     """
     VQ layer with EMA (Exponential Moving Average) for updating codebook
     """
-    def __init__(self, num_embeddings, embedding_dim, commitment_cost, decay, epsilon=1e-5):
+    def __init__(self, num_embeddings, embedding_dim, commitment_cost, decay, epsilon=1e-5, dist_dtype=None):
         super(VectorQuantizerEMA, self).__init__()
         
         self._embedding_dim = embedding_dim
         self._num_embeddings = num_embeddings
         
+        # codewords are updated by EMA only, not by the optimizer
         self.embeddings = nn.Embedding(self._num_embeddings, self._embedding_dim)
         self.embeddings.weight.data.normal_()
+        self.embeddings.weight.requires_grad_(False)
         self._commitment_cost = commitment_cost
+        self._dist_dtype = dist_dtype # optional lower precision for the distance matmul
         
         self.register_buffer('_ema_cluster_size', torch.zeros(num_embeddings))
-        self._ema_w = nn.Parameter(torch.Tensor(num_embeddings, self._embedding_dim))
-        self._ema_w.data.normal_()
+        self.register_buffer('_ema_w', torch.randn(num_embeddings, self._embedding_dim))
         
         self._decay = decay
         self._epsilon = epsilon
 
     def forward(self, inputs):
-        # convert inputs from BCHW -> BHWC
-        inputs = inputs.permute(0, 2, 3, 1).contiguous()
+        # convert inputs from BCHW -> BHWC (a free view for channels_last inputs)
+        inputs = inputs.permute(0, 2, 3, 1)
         input_shape = inputs.shape
         
         # Flatten input
-        flat_input = inputs.view(-1, self._embedding_dim)
+        flat_input = inputs.reshape(-1, self._embedding_dim)
         
-        # Calculate distances
-        distances = (torch.sum(flat_input**2, dim=1, keepdim=True) 
-                    + torch.sum(self.embeddings.weight**2, dim=1)
-                    - 2 * torch.matmul(flat_input, self.embeddings.weight.t()))
-            
-        # Encoding
-        encoding_indices = torch.argmin(distances, dim=1).unsqueeze(1)
-        encodings = torch.zeros(encoding_indices.shape[0], self._num_embeddings, device=inputs.device)
-        encodings.scatter_(1, encoding_indices, 1)
+        # Encoding with distances to the codewords (||x||^2 is constant for each row, so it is dropped for argmin)
+        codes_sq_half = 0.5 * self.embeddings.weight.pow(2).sum(1)
+        encoding_indices = _nearest_codes(flat_input, self.embeddings.weight.t(), codes_sq_half, dtype=self._dist_dtype)
+        counts = torch.bincount(encoding_indices, minlength=self._num_embeddings).float()
         
         # Quantize and unflatten
-        quantized = torch.matmul(encodings, self.embeddings.weight).view(input_shape)
+        quantized = F.embedding(encoding_indices, self.embeddings.weight).view(input_shape)
         
-        # Use EMA to update the embedding vectors
+        # Use EMA to update the embedding vectors (in place, no new parameters)
         if self.training:
-            self._ema_cluster_size = self._ema_cluster_size * self._decay + \
-                                     (1 - self._decay) * torch.sum(encodings, 0)
-            
-            # Laplace smoothing of the cluster size
-            n = torch.sum(self._ema_cluster_size.data)
-            self._ema_cluster_size = (
-                (self._ema_cluster_size + self._epsilon)
-                / (n + self._num_embeddings * self._epsilon) * n)
-            
-            dw = torch.matmul(encodings.t(), flat_input)
-            self._ema_w = nn.Parameter(self._ema_w * self._decay + (1 - self._decay) * dw)
-            
-            self.embeddings.weight = nn.Parameter(self._ema_w / self._ema_cluster_size.unsqueeze(1))
+            with torch.no_grad():
+                self._ema_cluster_size.mul_(self._decay).add_(counts, alpha=1 - self._decay)
+                
+                # Laplace smoothing of the cluster size
+                n = torch.sum(self._ema_cluster_size)
+                self._ema_cluster_size.add_(self._epsilon).div_(n + self._num_embeddings * self._epsilon).mul_(n)
+                
+                dw = torch.zeros_like(self._ema_w).index_add_(0, encoding_indices, flat_input)
+                self._ema_w.mul_(self._decay).add_(dw, alpha=1 - self._decay)
+                
+                self.embeddings.weight.data.copy_(self._ema_w / self._ema_cluster_size.unsqueeze(1))
         
         # Loss
         e_latent_loss = F.mse_loss(quantized.detach(), inputs)
@@ -120,11 +158,11 @@ class VectorQuantizerEMA(nn.Module):
         
         # Straight Through Estimator
         quantized = inputs + (quantized - inputs).detach()
-        avg_probs = torch.mean(encodings, dim=0)
-        perplexity = torch.exp(-torch.sum(avg_probs * torch.log(avg_probs + 1e-10)))
+        avg_probs = counts / encoding_indices.numel()
+        perplexity = torch.exp(torch.special.entr(avg_probs).sum())
         
-        # convert quantized from BHWC -> BCHW
-        return quantized.permute(0, 3, 1, 2).contiguous(), loss, perplexity
+        # convert quantized from BHWC -> BCHW (channels_last view, no copy)
+        return quantized.permute(0, 3, 1, 2), loss, perplexity
 
 class extVQ(nn.Module):
     """
@@ -133,79 +171,123 @@ class extVQ(nn.Module):
             if silo_kind (book_index) = 0: only shared codebook
             else: shared codebook + additional codebook
     """
-    def __init__(self, num_embeddings, embedding_dim, commitment_cost, silo_kinds):
+    def __init__(self, num_embeddings, embedding_dim, commitment_cost, silo_kinds, chunk_size=4096, dist_dtype=None):
         super(extVQ, self).__init__()
         
         self._embedding_dim = embedding_dim
         self._num_embeddings = num_embeddings
         
-        # initialize a single codebook
-        self.embed = nn.Embedding(self._num_embeddings, self._embedding_dim)
-        self.embed.weight.data.normal_()
-        
-        # initialize extensible codebook
-        self.embeddings = [] # all codewords
-        self.embeddings.append(self.embed) # shared codebook
-        self.embeddings.append(nn.Embedding(self._num_embeddings, self._embedding_dim))  # append an additional backup codebook for Kmeans initialization
-        self.codebooks = nn.ModuleList(self.embeddings) # extensible codebook
+        # initialize extensible codebook: all codebooks live in one contiguous tensor [num_books, K, D],
+        # book 0 is the shared codebook, book 1 the additional backup codebook for Kmeans initialization,
+        # and room is reserved for one additional codebook per data distribution
+        self.codebook_bank = nn.Parameter(torch.randn(silo_kinds + 1, self._num_embeddings, self._embedding_dim))
+        self._num_active = 2 # number of codebooks in use
 
         self._commitment_cost = commitment_cost
+        self._chunk_size = chunk_size # number of rows scored against the codewords at once
+        self._dist_dtype = dist_dtype # optional lower precision for the distance matmul
+
+        # cache of accessible codewords while the codebooks are frozen, invalidated by bumping the version
+        self._cache = {}
+        self._cache_version = 0
+
+    def reset_cache(self):
+        self._cache_version += 1
+        self._cache = {}
+
+    @property
+    def num_codebooks(self):
+        return self._num_active
+
+    def extend(self):
+        """
+        append a new randomly initialized codebook, doubling the bank when it is full;
+        doubling replaces .data of the same Parameter, which is only safe before an optimizer
+        holding it has taken a step (its state would keep the old shape), as in silo_training
+        where the codebooks are extended in the first forward
+        """
+        bank = self.codebook_bank.data
+        if self._num_active == bank.shape[0]:
+            self.codebook_bank.data = torch.cat((bank, torch.randn_like(bank)), dim=0)
+        else:
+            bank[self._num_active].normal_()
+        self._num_active += 1
+        self.reset_cache()
 
-    def forward(self, inputs, idx, ext=False):
+    def accessible_codes(self, idx, learnable_codebook=True):
+        """
+        return (codes, codes_t, codes_sq_half) of the codewords accessible to idx,
+        cached between codebook updates when no gradient flows into the codebooks
+        """
+        assert idx < self._num_active, "Codebook index {} is not active ({} codebooks)".format(idx, self._num_active)
+        bank = self.codebook_bank if learnable_codebook else self.codebook_bank.detach()
+        frozen = not (torch.is_grad_enabled() and bank.requires_grad)
+        # in-place optimizer steps and device moves are caught by the tensor version and storage
+        key = (self._cache_version, bank.data_ptr(), bank._version)
+        if frozen and idx in self._cache and self._cache[idx][0] == key:
+            return self._cache[idx][1]
+
+        if idx == 0:
+            # use only shared codebook
+            codes = bank[0]
+        elif idx == 1:
+            # shared codebook and the first additional codebook are adjacent in the bank
+            codes = bank[:2].flatten(0, 1)
+        else:
+            # Calculate distances with shared codebook and additional codebook
+            codes = torch.cat((bank[0], bank[idx]), dim=0)
+        # only the codeword lookup needs autograd, the distance terms are consumed under no_grad
+        with torch.no_grad():
+            entry = (codes, codes.t().contiguous(), 0.5 * codes.pow(2).sum(1))
+        if frozen:
+            self._cache[idx] = (key, entry)
+        return entry
+
+    def forward(self, inputs, idx, ext=False, learnable_codebook=True):
         """
         idx: the index of data distribution
+        learnable_codebook: if False, skip the codebook loss so no gradient flows into the codewords
         """
-        # convert inputs from BCHW -> BHWC
-        inputs = inputs.permute(0, 2, 3, 1).contiguous()
+        # convert inputs from BCHW -> BHWC (a free view for channels_last inputs)
+        inputs = inputs.permute(0, 2, 3, 1)
         input_shape = inputs.shape
         
         # Flatten input
-        flat_input = inputs.view(-1, self._embedding_dim)
+        flat_input = inputs.reshape(-1, self._embedding_dim)
         
         # extend codebook (append a new codebook for next Kmeans initialization)
         if ext:
-            self.codebooks.append(nn.Embedding(self._num_embeddings, self._embedding_dim))
+            self.extend()
 
         # accessible codewords for different silos
-        if idx == 0:
-            # use only shared codebook
-            codes = self.codebooks[0].weight
-        else:
-            # Calculate distances with shared codebook and additional codebook
-            codes = torch.cat((self.codebooks[0].weight, self.codebooks[idx].weight), dim=0)
+        codes, codes_t, codes_sq_half = self.accessible_codes(idx, learnable_codebook)
             
-        # Calculate distances to accessible codewords
-        distances = (
-            torch.sum(flat_input ** 2, dim=1, keepdim=True) +
-            torch.sum(codes ** 2, dim=1) -
-            2. * torch.matmul(flat_input, codes.t())
-        )
-            
-        # Encoding
-        encoding_indices = torch.argmin(distances, dim=1).unsqueeze(1)
-        encodings = torch.zeros(encoding_indices.shape[0], codes.shape[0]).to(inputs.device)
-        encodings.scatter_(1, encoding_indices, 1)
+        # Encoding with distances to accessible codewords (||x||^2 is dropped for argmin)
+        encoding_indices = _nearest_codes(flat_input, codes_t, codes_sq_half, self._chunk_size, self._dist_dtype)
+        counts = torch.bincount(encoding_indices, minlength=codes.shape[0]).float()
         
         # Quantize and unflatten
-        quantized = torch.matmul(encodings, codes).view(input_shape)
+        quantized = F.embedding(encoding_indices, codes).view(input_shape)
         
         # Loss
         e_latent_loss = F.mse_loss(quantized.detach(), inputs)
-        q_latent_loss = F.mse_loss(quantized, inputs.detach())
-        loss = q_latent_loss + self._commitment_cost * e_latent_loss
+        loss = self._commitment_cost * e_latent_loss
+        if learnable_codebook:
+            q_latent_loss = F.mse_loss(quantized, inputs.detach())
+            loss = q_latent_loss + loss
         
         quantized = inputs + (quantized - inputs).detach()
-        avg_probs = torch.mean(encodings, dim=0)
-        perplexity = torch.exp(-torch.sum(avg_probs * torch.log(avg_probs + 1e-10)))
+        avg_probs = counts / encoding_indices.numel()
+        perplexity = torch.exp(torch.special.entr(avg_probs).sum())
         
-        # convert quantized from BHWC -> BCHW
-        return quantized.permute(0, 3, 1, 2).contiguous(), loss, perplexity
+        # convert quantized from BHWC -> BCHW (channels_last view, no copy)
+        return quantized.permute(0, 3, 1, 2), loss, perplexity
     
 class UEFL(nn.Module):
     """
     Map latent features into codewords in an extensible codebook according to data distribution
     """
-    def __init__(self, input_ch, dim, depth, num_codes, data, enc, silo_kinds, seg, ema=False):
+    def __init__(self, input_ch, dim, depth, num_codes, data, enc, silo_kinds, seg, ema=False, dist_dtype=None):
         super().__init__()
         self.num_embeddings = num_codes
         self.dim = dim*2**(depth-1) # number of channels for encoded features of different datasets (i.e. codeword length)
@@ -224,7 +306,7 @@ class UEFL(nn.Module):
         self.dim = self.dim//seg
         
         # entensible codebook
-        self.discretizer = extVQ(num_embeddings=self.num_embeddings, embedding_dim=self.dim, commitment_cost=0.25, silo_kinds=silo_kinds)
+        self.discretizer = extVQ(num_embeddings=self.num_embeddings, embedding_dim=self.dim, commitment_cost=0.25, silo_kinds=silo_kinds, dist_dtype=dist_dtype)
         
         # number of classes for different datasets
         if data == "cifar100":
@@ -237,48 +319,56 @@ class UEFL(nn.Module):
 
     # initialize the additional codebooks with kmeans on local data
     def init_codebooks(self, dsloader, idx, device):
-        feas = []
-        # obatin features for all input data
+        centers, sums, counts = None, None, None
+        # stream the features of all input data through a running kmeans accumulator
         with torch.no_grad():
             for xtr, ytr in dsloader:
-                xtr, ytr = xtr.to(device), ytr.to(device)
+                xtr = xtr.to(device, non_blocking=True)
                 fea = self.encoder(xtr)
-                feas.append(fea.detach())
+                # [B, C, H, W] -> [BHW, C]
+                fea = fea.permute(0, 2, 3, 1).reshape(-1, self.dim)
+
+                # initial centers from kmeans on the first batch
+                if centers is None:
+                    centers = _gpu_kmeans(fea, self.num_embeddings)
+                    sums = torch.zeros_like(centers)
+                    counts = torch.zeros(self.num_embeddings, dtype=centers.dtype, device=centers.device)
 
-            feas = torch.concat(feas, dim=0)
-            feas = feas.permute(0, 2, 3, 1).contiguous()
-            # [B, H, W, C] -> [BHW, C]
-            feas = feas.reshape(-1, self.dim)
+                assign = _nearest_codes(fea, centers.t(), 0.5 * centers.pow(2).sum(1), chunk=65536)
+                sums.index_add_(0, assign, fea)
+                counts += torch.bincount(assign, minlength=self.num_embeddings)
 
-            # initialize codebooks
-            kmeans = KMeans(n_clusters=self.num_embeddings, random_state=0, n_init="auto").fit(feas.cpu().numpy())
-            self.discretizer.codebooks[idx].weight.data = torch.from_numpy(kmeans.cluster_centers_).to(device)
+            # initialize codebooks, empty clusters keep their initial center
+            counts = counts.unsqueeze(1)
+            centers = torch.where(counts > 0, sums / counts.clamp_min(1), centers)
+            assert idx < self.discretizer.num_codebooks, "Codebook index {} is not active ({} codebooks)".format(idx, self.discretizer.num_codebooks)
+            self.discretizer.codebook_bank.data[idx].copy_(centers)
+            self.discretizer.reset_cache()
     
-    # return codebooks
+    # return codebooks as a single [num_books, K, D] tensor
     def get_codebooks(self):
-        codebooks = []
-        for i in range(len(self.discretizer.codebooks)):
-            codebooks.append(self.discretizer.codebooks[i].weight)
-        return codebooks
+        return self.discretizer.codebook_bank[:self.discretizer.num_codebooks].detach().clone()
     
     # load codebooks
     def load_codebooks(self, codebooks):
-        for i in range(len(self.discretizer.codebooks)):
-            self.discretizer.codebooks[i].weight.data = codebooks[i]
+        n = self.discretizer.num_codebooks
+        self.discretizer.codebook_bank.data[:n].copy_(codebooks[:n])
+        self.discretizer.reset_cache()
 
     # extend codebook capacity
     def extend_codebooks(self, iteration):
         if iteration > 1:
-            self.discretizer.codebooks.append(nn.Embedding(self.num_embeddings, self.dim))
+            self.discretizer.extend()
                         
-    def forward(self, x, idx, ext=False):
+    def forward(self, x, idx, ext=False, learnable_codebook=True):
         '''
         if idx (book_index) = 0: only shared codebook
         else: shared codebook + additional codebook
+        learnable_codebook: whether the codebook loss (and its backward) is computed
         '''
         fea = self.encoder(x)
 
-        q_fea, loss, ppl = self.discretizer(fea, idx, ext)
+        q_fea, loss, ppl = self.discretizer(fea, idx, ext, learnable_codebook)
         q_fea = q_fea.flatten(1)
         # decoder with quantized vectors
         output = self.classifier(q_fea)
@@ -18,13 +18,21 @@ def main(args):
     silotr = []
     silote = []
     silotr, silote = build_slios(args)
+
+    # data loaders are built once and reused across rounds, so that background workers stay alive
+    loader_kwargs = {'pin_memory': device.type == 'cuda'}
+    if args.workers > 0:
+        loader_kwargs.update(num_workers=args.workers, persistent_workers=True, prefetch_factor=2)
+    train_loaders = [DataLoader(datatr, batch_size=args.batchsz, shuffle=True, **loader_kwargs) for datatr in silotr]
+    test_loaders = [DataLoader(datate, batch_size=args.batchte, shuffle=False, **loader_kwargs) for datate in silote]
     
     # model
     if args.data == 'cifar10' or args.data == 'cifar100' or args.data == 'gtsrb':
         input_ch = 3 # rgb dataset
     else:
         input_ch = 1 # gray dataset
-    mainmodel = UEFL(input_ch=input_ch, dim=args.dim, depth=args.depth, num_codes=args.num_codes, data=args.data, enc = args.encoder, silo_kinds=args.num_dist, seg=args.seg, ema=args.ema)
+    mainmodel = UEFL(input_ch=input_ch, dim=args.dim, depth=args.depth, num_codes=args.num_codes, data=args.data, enc = args.encoder, silo_kinds=args.num_dist, seg=args.seg, ema=args.ema, dist_dtype=torch.bfloat16 if args.bf16 else None)
+    mainmodel = mainmodel.to(memory_format=torch.channels_last) # keep features in BHWC order for the codebook lookup
 
     # results folder
     results_folder = os.path.join('./results', args.workdir)
@@ -63,10 +71,8 @@ def main(args):
             ########### training ###########
             avg_model = None
             for s in range(len(silotr)):
-                datatr = silotr[s]
-                datate = silote[s]
-                train_loader = DataLoader(datatr, batch_size=args.batchsz, shuffle=True)
-                test_loader = DataLoader(datate, batch_size=args.batchte, shuffle=False)
+                train_loader = train_loaders[s]
+                test_loader = test_loaders[s]
                 lr = args.lr # learning rate
                 # load local codebooks for each silo
                 if r>0:
@@ -101,8 +107,7 @@ def main(args):
                 vqlosses = []
                 ppls = []
                 for s in range(args.num_silo): # for each silo
-                    datate = silote[s]
-                    test_loader = DataLoader(datate, batch_size=args.batchte, shuffle=False)
+                    test_loader = test_loaders[s]
                     mainmodel.load_codebooks(codebooks[s]) # load local codebooks for each silo
                     test_loss, acc, pred, vqloss, ppl = validate(test_loader, mainmodel, device, args, book_idx[s])
                     accuracy.append(float("%.4f" % acc))
@@ -165,9 +170,11 @@ if __name__ == '__main__':
     argparser.add_argument('--num_codes', type=int, help='VQ codebook size', default=64)
     argparser.add_argument('--seg', type=int, help='how many segments', default=1)
     argparser.add_argument('--ema', action='store_true', help='whether use ema or not')
+    argparser.add_argument('--bf16', action='store_true', help='compute codeword distances in bfloat16 or not')
 
     # training
     argparser.add_argument('--dev', type=str, help='cuda device or cpu', default='cuda:0')
+    argparser.add_argument('--workers', type=int, help='number of data loading workers for each silo', default=0)
     argparser.add_argument('--round', type=int, help='number of federated learning rounds', default=20) # 10, 20, or 50
     argparser.add_argument('--round_plus', type=int, help='number of additional rounds', default=10) # 5
     argparser.add_argument('--epoch', type=int, help='number of local training epochs', default=20) # 5, 10 or 20
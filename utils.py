@@ -7,6 +7,44 @@ import torch.nn.functional as F
 import numpy as np
 import sys
 
+class CudaPrefetcher:
+    """
+    iterate over a data loader while copying the next batch to the device on a side cuda stream
+    """
+    def __init__(self, loader, device):
+        self.loader = iter(loader)
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
+        self.preload()
+
+    def preload(self):
+        try:
+            batch = next(self.loader)
+        except StopIteration:
+            self.batch = None
+            return
+        if self.stream is None:
+            self.batch = [t.to(self.device) for t in batch]
+        else:
+            with torch.cuda.stream(self.stream):
+                self.batch = [t.to(self.device, non_blocking=True) for t in batch]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch = self.batch
+        if batch is None:
+            raise StopIteration
+        if self.stream is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(self.stream)
+            # the batch was allocated on the side stream but is consumed on the current one
+            for t in batch:
+                t.record_stream(current)
+        self.preload()
+        return batch
+
 def running_uefl_avg(current, next, scale):
     """
     compute the average of the model parameters, except for the codebooks
@@ -42,7 +80,7 @@ def validate(test_loader, model, device, args, net_idx):
 
     with torch.no_grad():
         for xte, yte in test_loader:
-            xte = xte.to(device)
+            xte = xte.to(device, non_blocking=True)
             pte, vqloss, ppl = model(xte, net_idx)
             test_vqloss += vqloss.item()
             test_ppl += ppl.item()
@@ -68,13 +106,11 @@ def silo_training(train_loader, test_loader, model, device, args, lr, net_idx, i
     loss_tr = []
     train_loss = 0.0
     if init_and_ext:
-        localmodel.init_codebooks(train_loader, net_idx, device) # locally initialize the codebooks with kmeans
+        localmodel.init_codebooks(CudaPrefetcher(train_loader, device), net_idx, device) # locally initialize the codebooks with kmeans
 
     for e in range(args.epoch):
         localmodel.train()
-        for xtr, ytr in train_loader:
-            xtr, ytr = xtr.to(device), ytr.to(device)
-
+        for xtr, ytr in CudaPrefetcher(train_loader, device):
             optimizer.zero_grad()
             ptr, train_vqloss, train_ppl = localmodel(xtr, net_idx, ext=init_and_ext)
             init_and_ext = False # reset extension flag after extending the codebooks, extend only once for each silo